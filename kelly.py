@@ -1,4 +1,62 @@
 import numpy as np
+from numba import njit, prange
+
+@njit(nogil = True, cache = True)
+def _solve(odds, prob):
+    #returns the competitor indices to bet on, ordered by expected return, and their bet fractions
+    eret = odds * prob
+    n = eret.shape[0]
+    if n < 32:
+        #insertion sort in descending order of expected return, cheaper than argsort for typical field sizes
+        indices = np.arange(n)
+        for i in range(1, n):
+            j = i
+            while j > 0 and eret[indices[j - 1]] < eret[indices[j]]:
+                indices[j - 1], indices[j] = indices[j], indices[j - 1]
+                j -= 1
+    else:
+        indices = np.argsort(eret)[::-1]
+    odds = odds[indices]
+    prob = prob[indices]
+    eret = eret[indices]
+
+    if eret[0] <= 1: #it means no edge so no betting
+        return indices[:0], prob[:0]
+
+    #v = min((1 - csprob) / (1 - csrodds)) over the positive ratios, in one pass over the cumulative sums
+    v = np.inf
+    n_pos = 0
+    csprob = 0.0
+    csrodds = 0.0
+    for k in range(odds.shape[0]):
+        csprob += prob[k]
+        csrodds += 1.0 / odds[k]
+        num = 1.0 - csprob
+        den = 1.0 - csrodds
+        if den != 0.0:
+            t = num / den
+            if t > 0.0:
+                n_pos += 1
+                v = t if t < v else v
+    bf = prob - v / odds
+    bf = np.where(bf < 0, 0, bf)
+    return indices[:n_pos], bf[:n_pos]
+
+@njit(parallel = True, nogil = True, cache = True)
+def _batch(odds, prob, out):
+    #one race per row, out[r, i] is the bet fraction on competitor i of race r
+    for r in prange(odds.shape[0]):
+        indices, bf = _solve(odds[r], prob[r])
+        out[r, :] = 0.0
+        for k in range(indices.shape[0]):
+            out[r, indices[k]] = bf[k]
+
+def _invalid_races(odds, prob, tol):
+    #flags the races (last axis = competitors) whose prob sums up to more than 1 + tol
+    #and those with any odds not larger than 1, shared by the single-race and batch checks
+    bad_prob = prob.sum(axis = -1) - 1 > tol
+    bad_odds = (odds <= 1).any(axis = -1)
+    return bad_prob, bad_odds
 
 class MultiKellyBettor:
     '''
@@ -9,6 +67,10 @@ class MultiKellyBettor:
     odds : win odds of each competitor
     prob : winning probability of each competitor
     label : names of each competitor (optional)
+    validate : whether to check the inputs, True as default. Pass False to skip the checks
+               for trusted inputs
+    tol : how far prob may sum up above 1 before it is rejected. 1e6 as default, which keeps
+          the historical behaviour of accepting any prob; pass e.g. 1e-6 for a strict check
 
     Output
     ------
@@ -22,49 +84,66 @@ class MultiKellyBettor:
     3. https://www.sportsbookreview.com/forum/handicapper-think-tank/521569-simple-closed-form-solution-unconstrained-simultaneous-bet-kelly-staking.html
 
     '''
-    def __init__(self, odds, prob, label = []):
-        self.odds = np.array(odds)
-        self.prob = np.array(prob)
-
-        if len(self.odds.shape) != 1 or len(self.prob.shape) != 1:
-            raise ValueError('The dimension of odds and prob must be 1.')
-        if self.odds.shape != self.prob.shape:
-            raise ValueError('The length of odds does not match the length of prob.')
-        if np.sum(self.prob) - 1 > 1e6:
-            raise ValueError('prob does not sum up to 1.')
-        if np.any(self.odds <= 1):
-            raise ValueError('odds must be all larger than 1.')
+    def __init__(self, odds, prob, label = [], validate = True, tol = 1e6):
+        self.odds = np.array(odds, dtype = np.float64)
+        self.prob = np.array(prob, dtype = np.float64)
+
+        if validate:
+            if len(self.odds.shape) != 1 or len(self.prob.shape) != 1:
+                raise ValueError('The dimension of odds and prob must be 1.')
+            if self.odds.shape != self.prob.shape:
+                raise ValueError('The length of odds does not match the length of prob.')
+            bad_prob, bad_odds = _invalid_races(self.odds, self.prob, tol)
+            if bad_prob:
+                raise ValueError('prob does not sum up to 1.')
+            if bad_odds:
+                raise ValueError('odds must be all larger than 1.')
 
         if not label:
             label = list(range(len(odds)))
-        elif len(odds) != len(label):
+        elif validate and len(odds) != len(label):
             raise ValueError('The length of label does not match.')
         self.label = label
         
     def transform(self):
         prop = {self.label[k] : 0 for k in range(len(self.odds))}
-        eret = np.array([o * p for o, p in zip(self.odds, self.prob)])
-        indices = np.argsort(eret)[::-1]
-        odds = self.odds[indices]
-        prob = self.prob[indices]
-        eret = eret[indices]
-        
-        if eret[0] <= 1: #it means no edge so no betting
-            return prop
-        
-        rodds = 1 / odds
-        csprob = np.cumsum(prob)
-        csrodds = np.cumsum(rodds)
-        tmp = (1 - csprob) / (1 - csrodds)
-        tmp = tmp[tmp > 0]
-        v = tmp.min()
-        bf = prob - v / odds
-        bf = np.where(bf < 0, 0, bf)
-        
-        for k in range(len(tmp)):
+        indices, bf = _solve(self.odds, self.prob)
+        for k in range(len(indices)):
             prop[self.label[indices[k]]] = bf[k]
         return prop
 
+    @staticmethod
+    def transform_batch(odds_batch, prob_batch, validate = True, tol = 1e6):
+        '''
+        Kelly proportions for many races at once.
+
+        Parameters
+        ----------
+        odds_batch : 2D array of win odds with shape (n_races, n_competitors)
+        prob_batch : 2D array of winning probabilities with the same shape
+        validate : whether to check the inputs, True as default. The checks run once over the
+                   whole batch and report the offending races
+        tol : same as in the constructor, applied to every race
+
+        Output
+        ------
+        bf : 2D array with the same shape, bf[r, i] being the proportion of the whole capital
+             to bet on competitor i of race r
+        '''
+        odds_batch = np.ascontiguousarray(odds_batch, dtype = np.float64)
+        prob_batch = np.ascontiguousarray(prob_batch, dtype = np.float64)
+        if len(odds_batch.shape) != 2 or odds_batch.shape != prob_batch.shape:
+            raise ValueError('odds_batch and prob_batch must be 2D arrays of the same shape.')
+        if validate:
+            bad_prob, bad_odds = _invalid_races(odds_batch, prob_batch, tol)
+            if bad_prob.any():
+                raise ValueError('prob does not sum up to 1 in races {}.'.format(np.flatnonzero(bad_prob).tolist()))
+            if bad_odds.any():
+                raise ValueError('odds must be all larger than 1 in races {}.'.format(np.flatnonzero(bad_odds).tolist()))
+        bf = np.empty_like(odds_batch)
+        _batch(odds_batch, prob_batch, bf)
+        return bf
+
 if __name__ == '__main__':
     mkb = MultiKellyBettor(odds = [1.87, 3.4, 3.4], 
                            prob = [0.592, 0.285, 0.123], 
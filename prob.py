@@ -1,5 +1,167 @@
 import numpy as np
 from itertools import permutations
+from numba import njit, prange
+
+_PERMS3 = np.array(list(permutations(range(3))))
+_PERMS4 = np.array(list(permutations(range(4))))
+
+@njit(parallel = True, nogil = True, fastmath = True, cache = True)
+def _build_pij(p_i, p_i2, out):
+    #out[i, j] = p_i2[i] * p_i[j] / (1 - p_i2[j]), 0 on the diagonal or where the denominator vanishes
+    n = p_i.shape[0]
+    ratio = np.empty(n, dtype = out.dtype)
+    for j in range(n):
+        denom = 1.0 - p_i2[j]
+        if denom != 0.0:
+            ratio[j] = p_i[j] / denom
+        else:
+            ratio[j] = 0.0
+    for i in prange(n):
+        for j in range(n):
+            out[i, j] = 0.0 if i == j else p_i2[i] * ratio[j]
+
+@njit(parallel = True, nogil = True, fastmath = True, cache = True)
+def _build_pijk(p_ij, p_i3, out):
+    #out[i, j, k] = p_ij[i, j] / (1 - p_i3[i] - p_i3[j]) * p_i3[k], 0 whenever two indices collide
+    #or the denominator vanishes; every element of out is written
+    n = p_i3.shape[0]
+    for i in prange(n):
+        for j in range(n):
+            denom = 1.0 - p_i3[i] - p_i3[j]
+            if i != j and denom != 0.0:
+                base = p_ij[i, j] / denom
+            else:
+                base = 0.0
+            for k in range(n):
+                out[i, j, k] = 0.0 if (k == i or k == j) else base * p_i3[k]
+
+@njit(parallel = True, nogil = True, fastmath = True, cache = True)
+def _build_pijkl(p_ijk, p_i4, out):
+    #out[i, j, k, l] = p_ijk[i, j, k] / (1 - p_i4[i] - p_i4[j] - p_i4[k]) * p_i4[l], 0 whenever two indices
+    #collide or the denominator vanishes; every element of out is written
+    n = p_i4.shape[0]
+    for i in prange(n):
+        for j in range(n):
+            for k in range(n):
+                denom = 1.0 - p_i4[i] - p_i4[j] - p_i4[k]
+                if i != j and k != i and k != j and denom != 0.0:
+                    base = p_ijk[i, j, k] / denom
+                else:
+                    base = 0.0
+                for l in range(n):
+                    out[i, j, k, l] = 0.0 if (l == i or l == j or l == k) else base * p_i4[l]
+
+@njit(parallel = True, nogil = True, fastmath = True, cache = True)
+def _first4(p_ijk, p_i4, perms, out):
+    #first_4 straight from p_ijk: for each i<j<k<l, sums the Harville p_ijkl over its 24 orderings
+    #without building p_ijkl, and scatters the sum into all of them
+    #out is expected to be zero-initialized
+    n = p_i4.shape[0]
+    for i in prange(n):
+        idx = np.empty(4, dtype = np.int64)
+        idx[0] = i
+        for j in range(i + 1, n):
+            idx[1] = j
+            for k in range(j + 1, n):
+                idx[2] = k
+                for l in range(k + 1, n):
+                    idx[3] = l
+                    s = 0.0
+                    for q in range(perms.shape[0]):
+                        a = idx[perms[q, 0]]
+                        b = idx[perms[q, 1]]
+                        c = idx[perms[q, 2]]
+                        denom = 1.0 - p_i4[a] - p_i4[b] - p_i4[c]
+                        if denom != 0.0:
+                            s += p_ijk[a, b, c] / denom * p_i4[idx[perms[q, 3]]]
+                    for q in range(perms.shape[0]):
+                        out[idx[perms[q, 0]], idx[perms[q, 1]], idx[perms[q, 2]], idx[perms[q, 3]]] = s
+
+@njit(parallel = True, nogil = True, fastmath = True, cache = True)
+def _place(p_i, p_ij, p_ijk, out):
+    #out[k] = p_i[k] + ∑_j p_ij[k, j] + ∑_i ∑_j p_ijk[i, j, k]
+    n = p_i.shape[0]
+    for k in prange(n):
+        s2 = 0.0
+        for j in range(n):
+            s2 += p_ij[k, j]
+        s3 = 0.0
+        for i in range(n):
+            for j in range(n):
+                s3 += p_ijk[i, j, k]
+        out[k] = p_i[k] + s2 + s3
+
+@njit(parallel = True, nogil = True, fastmath = True, cache = True)
+def _place_rk3(p_ij, p_i3, out):
+    #out[k] = ∑_i ∑_j p_ijk[i, j, k], evaluated straight from the Harville formula without building p_ijk
+    n = p_i3.shape[0]
+    for k in prange(n):
+        acc = 0.0
+        pk = p_i3[k]
+        for i in range(n):
+            if i == k:
+                continue
+            for j in range(n):
+                if j == i or j == k:
+                    continue
+                d = 1.0 - p_i3[i] - p_i3[j]
+                if d != 0.0:
+                    acc += p_ij[i, j] * pk / d
+        out[k] = acc
+
+@njit(parallel = True, nogil = True, fastmath = True, cache = True)
+def _sym_add(a, out):
+    #out = a + a.T without materializing the transpose
+    n = a.shape[0]
+    for i in prange(n):
+        for j in range(n):
+            out[i, j] = a[i, j] + a[j, i]
+
+@njit(parallel = True, nogil = True, fastmath = True, cache = True)
+def _sym_add3(a, b, c, out):
+    #out = a + a.T + b + b.T + c + c.T in a single pass
+    n = a.shape[0]
+    for i in prange(n):
+        for j in range(n):
+            out[i, j] = a[i, j] + a[j, i] + b[i, j] + b[j, i] + c[i, j] + c[j, i]
+
+@njit(parallel = True, nogil = True, fastmath = True, cache = True)
+def _symmetrize3(p, perms, out):
+    #sums p over the 6 orderings of each i<j<k once and scatters the sum into all of them
+    #out is expected to be zero-initialized
+    n = p.shape[0]
+    for i in prange(n):
+        idx = np.empty(3, dtype = np.int64)
+        idx[0] = i
+        for j in range(i + 1, n):
+            idx[1] = j
+            for k in range(j + 1, n):
+                idx[2] = k
+                s = 0.0
+                for q in range(perms.shape[0]):
+                    s += p[idx[perms[q, 0]], idx[perms[q, 1]], idx[perms[q, 2]]]
+                for q in range(perms.shape[0]):
+                    out[idx[perms[q, 0]], idx[perms[q, 1]], idx[perms[q, 2]]] = s
+
+@njit(parallel = True, nogil = True, fastmath = True, cache = True)
+def _symmetrize4(p, perms, out):
+    #sums p over the 24 orderings of each i<j<k<l once and scatters the sum into all of them
+    #out is expected to be zero-initialized
+    n = p.shape[0]
+    for i in prange(n):
+        idx = np.empty(4, dtype = np.int64)
+        idx[0] = i
+        for j in range(i + 1, n):
+            idx[1] = j
+            for k in range(j + 1, n):
+                idx[2] = k
+                for l in range(k + 1, n):
+                    idx[3] = l
+                    s = 0.0
+                    for q in range(perms.shape[0]):
+                        s += p[idx[perms[q, 0]], idx[perms[q, 1]], idx[perms[q, 2]], idx[perms[q, 3]]]
+                    for q in range(perms.shape[0]):
+                        out[idx[perms[q, 0]], idx[perms[q, 1]], idx[perms[q, 2]], idx[perms[q, 3]]] = s
 
 class ProbProber:
     '''
@@ -16,20 +178,30 @@ class ProbProber:
         c_4), used in the correction formular p_i'=(p_i^c)/(∑_j (p_j)^c) (note that if c = 1, the
         probability does not change). Based on maximum likelihood estimation, Benter suggests that c_2 =
         0.81 and c_3 = 0.65. 
+    dtype : Floating point type of the probabilities, np.float64 as default. np.float32 halves the memory
+        traffic of the larger pools (tierce, trio, quartet, first_4) at the cost of precision, which is
+        worth it when there are many competitors.
     pool : Can be win, quinella, tierce, trio, place, place_q, quartet or first_4
 
     Output
     ------
-    An array that stores the winning probability of all combinations.
+    An array that stores the winning probability of all combinations. The array is reused by later
+    calls with the same pool, so copy it before modifying it. For use from several threads, give each
+    thread its own ProbProber and set NUMBA_THREADING_LAYER=omp.
     
     '''
-    def __init__(self, wos, c = [1, 1, 1, 1]):
-        self.wos = np.array(wos)
+    def __init__(self, wos, c = [1, 1, 1, 1], dtype = np.float64):
+        self.dtype = dtype
+        self.wos = np.array(wos, dtype = dtype)
         self.c = c
         #order probabilities for specific competitor(s)
         #p_i means the probability for horse i ranks first
         #p_ij is the probability for horse i ranks first and horse j ranks second (i≠j) and so on. 
         self.p_i, self.p_ij, self.p_ijk, self.p_ijkl  = None, None, None, None 
+        #corrected probabilities p_i' for each of the 4 ranks, see _norm_pow
+        self._p_ik = [None] * 4
+        #output buffers of the derived pools, keyed by pool
+        self._buf = {}
         if len(c) < 4:
             c.extend([1] * (4 - len(c)))
         self.pools = ["win", "quinella", "tierce", "trio", "place", "place_q", "quartet", "first_4"]
@@ -42,13 +214,23 @@ class ProbProber:
         if pool not in self.pools:
             raise ValueError('Invalid pool: {}'.format(pool))
         
+    def _norm_pow(self, k):
+        if self._p_ik[k] is None:
+            nppow = np.power(self.wos, self.c[k])
+            self._p_ik[k] = nppow / nppow.sum()
+        return self._p_ik[k]
+        
+    def _buffer(self, pool, shape):
+        if pool not in self._buf:
+            self._buf[pool] = np.empty(shape, dtype = self.dtype)
+        return self._buf[pool]
+        
     def transform(self, pool = 'win'):
         self._check_pool(pool)
         dim = len(self.wos)
         
         if self.p_i is None:
-            nppow = np.power(self.wos, self.c[0])
-            self.p_i = nppow / nppow.sum()
+            self.p_i = self._norm_pow(0)
         
         if pool == 'win':
             return self.p_i
@@ -56,67 +238,62 @@ class ProbProber:
         self._check_dim(dim, 2)
         
         if self.p_ij is None:
-            nppow = np.power(self.wos, self.c[1])
-            p_i2 =  nppow / nppow.sum()
-            self.p_ij = p_i2.reshape(-1, 1) * (self.p_i / (1 - p_i2))
-            self.p_ij[np.diag_indices(dim, ndim = 2)] = 0
+            self.p_ij = np.empty((dim, dim), dtype = self.dtype)
+            _build_pij(self.p_i, self._norm_pow(1), self.p_ij)
             
         if pool == 'quinella':
-            return self.p_ij + self.p_ij.T
+            quinella = self._buffer(pool, (dim, dim))
+            _sym_add(self.p_ij, quinella)
+            return quinella
         
         self._check_dim(dim, 3)
 
+        if pool == 'place' and self.p_ijk is None:
+            place = self._buffer(pool, dim)
+            _place_rk3(self.p_ij, self._norm_pow(2), place)
+            place += self.p_i + self.p_ij.sum(axis = 1)
+            return place
+
         if self.p_ijk is None: 
-            nppow = np.power(self.wos, self.c[2])
-            p_i3 =  nppow / nppow.sum()
-            comp = np.tile(p_i3.reshape(-1, 1), dim)
-            comp = 1 - comp - comp.T
-            comp = np.divide(self.p_ij, comp, where = comp != 0)
-            self.p_ijk = comp.reshape(*comp.shape, -1) * p_i3.reshape(1, dim)
-            self.p_ijk.transpose([2, 1, 0])[np.diag_indices(dim, ndim = 2)] = 0
-            self.p_ijk.transpose([2, 0, 1])[np.diag_indices(dim, ndim = 2)] = 0
+            self.p_ijk = np.empty((dim, dim, dim), dtype = self.dtype)
+            _build_pijk(self.p_ij, self._norm_pow(2), self.p_ijk)
         
         if pool == 'tierce':
             return self.p_ijk
         elif pool == 'trio':
-            trio = 0
-            for perm in permutations(range(3)):
-                trio += self.p_ijk.transpose(perm)
+            trio = self._buffer(pool, (dim, dim, dim))
+            trio[...] = 0
+            _symmetrize3(self.p_ijk, _PERMS3, trio)
             return trio
         elif pool == 'place':
-            p_rk2 = self.p_ij.sum(axis = 1)
-            p_rk3 = self.p_ijk.sum(axis = 1).sum(axis = 0)
-            return self.p_i + p_rk2 + p_rk3
+            place = self._buffer(pool, dim)
+            _place(self.p_i, self.p_ij, self.p_ijk, place)
+            return place
         elif pool == 'place_q':
-            p_dot_i_j = self.p_ijk.sum(axis = 0)
-            p_i_dot_j = self.p_ijk.sum(axis = 1)
-            return self.p_ij + self.p_ij.T + \
-                   p_i_dot_j + p_i_dot_j.T + \
-                   p_dot_i_j + p_dot_i_j.T
+            p_dot_i_j = np.einsum('ijk->jk', self.p_ijk)
+            p_i_dot_j = np.einsum('ijk->ik', self.p_ijk)
+            place_q = self._buffer(pool, (dim, dim))
+            _sym_add3(self.p_ij, p_i_dot_j, p_dot_i_j, place_q)
+            return place_q
         
         self._check_dim(dim, 4)
+
+        if pool == 'first_4' and self.p_ijkl is None:
+            first_4 = self._buffer(pool, (dim, dim, dim, dim))
+            first_4[...] = 0
+            _first4(self.p_ijk, self._norm_pow(3), _PERMS4, first_4)
+            return first_4
         
         if self.p_ijkl is None:
-            nppow = np.power(self.wos, self.c[3])
-            p_i4 = nppow / nppow.sum()
-            comp = np.tile(p_i4, (dim, dim, 1))
-            comp = 1 - comp - comp.T - comp.transpose([0, 2, 1])
-            comp = np.divide(self.p_ijk, comp, where = comp != 0)
-            self.p_ijkl = comp.reshape(*comp.shape, -1) * p_i4.reshape(1, dim)
-            for i in range(dim):
-                self.p_ijkl[i, :, :, i] = 0
-                self.p_ijkl[:, i, :, i] = 0
-                self.p_ijkl[:, :, i, i] = 0
-                self.p_ijkl[i, :, i, :] = 0
-                self.p_ijkl[:, i, i, :] = 0
-                self.p_ijkl[i, i, :, :] = 0
+            self.p_ijkl = np.empty((dim, dim, dim, dim), dtype = self.dtype)
+            _build_pijkl(self.p_ijk, self._norm_pow(3), self.p_ijkl)
         
         if pool == 'quartet':
             return self.p_ijkl
         elif pool == 'first_4':
-            first_4 = 0
-            for perm in permutations(range(4)):
-                first_4 += self.p_ijkl.transpose(perm)
+            first_4 = self._buffer(pool, (dim, dim, dim, dim))
+            first_4[...] = 0
+            _symmetrize4(self.p_ijkl, _PERMS4, first_4)
             return first_4
     
         #unreachable